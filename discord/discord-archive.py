@@ -1,13 +1,16 @@
 from dotenv import load_dotenv
 from pathlib import Path
+from urllib.parse import urlsplit
 import os
 import shutil
 import re
 import json
 import sys
 import sqlite3
+import asyncio
+import aiofiles
+import aiohttp
 import discord
-import requests
 
 load_dotenv()
 
@@ -16,39 +19,81 @@ intents.members = True
 
 client = discord.Client(intents=intents)
 
+# The ID of the guild we wanna backup
+GUILD_ID = int(os.environ["GUILD"])
+
+# Number of messages to buffer before writing them to the database
+BATCH_SIZE = 500
+# Number of downloads to queue up before starting them
+DOWNLOAD_BATCH_SIZE = 256
+# Maximum number of simultaneous downloads from discord's CDN
+MAX_DOWNLOADS = 16
+# Name color of users and roles that don't have a color set
+DEFAULT_COLOR = discord.colour.Colour.default()
+
+# This does not mimic discord's parsing 100% accurately, but comes close enough.
+# It differs from discord in some special cases like escaped backslashes and backticks that
+# don't constitute a code block - discord's parsing itself seems weird in this case and was
+# hard to reproduce. For example, in discord ``foo` counts as a code block but `foo`` doesn't.
+# Triple backticks are tried first, then double, then single, all in one pass.
+CODE_BLOCK_REGEX = re.compile(r"(?<!\\)(?:```[^`]*```|``[^`]*``|`[^`]*`)")
+STATIC_EMOJI_REGEX = re.compile(r"(?<!\\)<:\w+:(\d+)>")
+GIF_EMOJI_REGEX = re.compile(r"(?<!\\)<a:\w+:(\d+)>")
+
 def get_guild():
-    guild = client.get_guild(int(os.environ["GUILD"]))
+    guild = client.get_guild(GUILD_ID)
 
     if guild is None:
-        print(f"Error: guild {os.environ['GUILD']} not found")
+        print(f"Error: guild {GUILD_ID} not found")
         sys.exit()
 
     return guild
 
 
+def get_connection(backup_path):
+    # Autocommit mode, so that transactions are only opened where we explicitly BEGIN them
+    conn = sqlite3.connect(backup_path / "backup.db", isolation_level=None)
+    # WAL + synchronous=NORMAL means commits don't have to wait for an fsync of the whole database
+    conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-65536;
+        PRAGMA mmap_size=10737418240;
+    """)
+    return conn
+
+
+async def download(session, semaphore, url, path):
+    async with semaphore:
+        async with session.get(url) as r, aiofiles.open(path, "wb") as f:
+            # Stream the file to disk so large attachments aren't held in memory
+            async for chunk in r.content.iter_chunked(1 << 16):
+                await f.write(chunk)
+
+
 @client.event
 async def on_ready():
     print(f"Logged in as {client.user}")
     if input("\nHit enter to backup or type something to cancel: ") == "":
-        await initialize_backup()
-        await backup_messages()
-        await index_messages()
+        # The guild we wanna backup
+        guild = get_guild()
+        backup_path = Path(str(GUILD_ID))
+        await initialize_backup(guild, backup_path)
+        await backup_messages(guild, backup_path)
+        await index_messages(backup_path)
         print("\nBackup complete")
     sys.exit()
 
 
-async def initialize_backup():
-    # The guild we wanna backup
-    guild = get_guild()
-
+async def initialize_backup(guild, backup_path):
     # Create the backup directory
-    backup_path = Path(str(guild.id))
     if backup_path.exists():
         shutil.rmtree(backup_path)
     os.mkdir(backup_path)
 
     # Save the guild icon
-    icon = str(guild.icon_url).split("/")[-1].split("?")[0]
+    icon = urlsplit(str(guild.icon_url)).path.rsplit("/", 1)[-1]
     await guild.icon_url.save(backup_path / icon)
 
     # Save guild info
@@ -62,7 +107,7 @@ async def initialize_backup():
     with open(backup_path / "info.json", "w") as f:
         json.dump(guild_info, f)
 
-    conn = sqlite3.connect(backup_path / "backup.db")
+    conn = get_connection(backup_path)
     cur = conn.cursor()
     # Create roles table
     cur.execute("DROP TABLE IF EXISTS roles")
@@ -71,30 +116,31 @@ async def initialize_backup():
             name TEXT NOT NULL,
             color TEXT
         )""")
+    cur.execute("BEGIN")
     for role in guild.roles:
         # If the name color is the default color, save it as None
         color = str(role.color)
-        if role.color == discord.colour.Colour.default():
+        if role.color == DEFAULT_COLOR:
             color = None
         # Save the role to the database
         cur.execute("INSERT INTO roles VALUES (?, ?, ?)", (role.id, role.name, color))
-    conn.commit()
+    cur.execute("COMMIT")
     conn.close()
 
 
-async def backup_messages():
-    # The guild we wanna backup
-    guild = get_guild()
-
-    backup_path = Path(str(guild.id))
+async def backup_messages(guild, backup_path):
     # Create directories to store assets
     for asset in ["avatars", "emoji", "attachments"]:
         if (backup_path / asset).exists():
             shutil.rmtree(backup_path / asset)
         os.mkdir(backup_path / asset)
+    # Emoji and attachments that have already been saved, to avoid checking the filesystem for
+    # every message
+    saved_emoji = {path.name for path in (backup_path / "emoji").iterdir()}
+    saved_attachments = set()
 
     # Create a database connection
-    conn = sqlite3.connect(backup_path / "backup.db")
+    conn = get_connection(backup_path)
     cur = conn.cursor()
     # (Re)create tables
     cur.execute("DROP TABLE IF EXISTS messages")
@@ -128,21 +174,85 @@ async def backup_messages():
             avatar TEXT NOT NULL,
             bot INTEGER NOT NULL
         )""")
+    # The attachments and reactions of each message, so that they can be queried without parsing
+    # the space separated strings in the messages table
+    cur.execute("DROP TABLE IF EXISTS message_attachments")
+    cur.execute("""CREATE TABLE message_attachments (
+            message_id INTEGER NOT NULL,
+            url TEXT NOT NULL
+        )""")
+    cur.execute("DROP TABLE IF EXISTS message_reactions")
+    cur.execute("""CREATE TABLE message_reactions (
+            message_id INTEGER NOT NULL,
+            emoji TEXT NOT NULL,
+            user_id TEXT NOT NULL
+        )""")
 
-    # This does not mimic discord's parsing 100% accurately, but comes close enough.
-    # It differs from discord in some special cases like escaped backslashes and backticks that
-    # don't constitute a code block - discord's parsing itself seems weird in this case and was
-    # hard to reproduce. For example, in discord ``foo` counts as a code block but `foo`` doesn't.
-    triple_backtick = re.compile(r"(?<!\\)(```[^`]*```)*")
-    double_backtick = re.compile(r"(?<!\\)(``[^`]*``)*")
-    single_backtick = re.compile(r"(?<!\\)(`[^`]*`)*")
-    static_emoji_regex = re.compile(r"(?<!\\)<:\w+:(\d+)>")
-    gif_emoji_regex = re.compile(r"(?<!\\)<a:\w+:(\d+)>")
+    # Rows waiting to be written to the database
+    # Users are indexed by their ID so that each of them is only inserted once per channel
+    pending_users = {}
+    pending_messages = []
+    pending_attachments = []
+    pending_reactions = []
+
+    def flush_messages():
+        cur.executemany(
+            "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            pending_messages,
+        )
+        cur.executemany("INSERT INTO message_attachments VALUES (?, ?)", pending_attachments)
+        cur.executemany("INSERT INTO message_reactions VALUES (?, ?, ?)", pending_reactions)
+        pending_messages.clear()
+        pending_attachments.clear()
+        pending_reactions.clear()
+
+    def flush_users():
+        # Inserting in primary key order fills the B-tree in page order instead of at random
+        cur.executemany(
+            "INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)",
+            [pending_users[user_id] for user_id in sorted(pending_users)],
+        )
+        pending_users.clear()
+
+    # Emoji and attachments are downloaded concurrently in batches, indexed by their path
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=32))
+    semaphore = asyncio.Semaphore(MAX_DOWNLOADS)
+    pending_downloads = {}
+
+    async def download_pending():
+        await asyncio.gather(*[
+            download(session, semaphore, url, path) for path, url in pending_downloads.items()
+        ])
+        pending_downloads.clear()
+
+    # Avatar paths (relative to the avatars directory) indexed by user ID and avatar hash
+    avatar_cache = {}
+    # Avatars that have already been saved, which can be shared by multiple users
+    saved_avatars = set()
+
+    async def save_avatar(user):
+        # Saves the user's avatar if needed and returns its path relative to the avatars directory
+        key = (user.id, user.avatar)
+        if key not in avatar_cache:
+            asset = user.avatar_url_as(format="webp")
+            # The query string is already separated out by urlsplit
+            directory, filename = urlsplit(str(asset)).path.rsplit("/", 2)[-2:]
+            directory_path = backup_path / "avatars" / directory
+            avatar = f"{directory}/{filename}"
+            if avatar not in saved_avatars:
+                directory_path.mkdir(exist_ok=True)
+                if not (directory_path / filename).exists():
+                    await asset.save(directory_path / filename)
+                saved_avatars.add(avatar)
+            avatar_cache[key] = avatar
+        return avatar_cache[key]
 
     # Iterate over all the text channels
     for channel in guild.channels:
         if channel.type == discord.ChannelType(0):
             print(f"\nStarting backup of channel {channel.name}")
+            # Each channel is saved in a single transaction
+            cur.execute("BEGIN")
             # Save the channel to the database
             cur.execute("INSERT INTO chats VALUES (?, ?, ?)", (
                 channel.id, channel.name, channel.topic
@@ -150,18 +260,21 @@ async def backup_messages():
 
             async for message in channel.history(limit=None, oldest_first=True):
                 # Download avatars
-                directory_path = backup_path / "avatars" / str(message.author.avatar_url_as(format="webp")).split("/")[-2]
-                directory_path.mkdir(exist_ok=True)
-                if not (directory_path / str(message.author.avatar_url_as(format="webp")).split("/")[-1].split("?")[0]).exists():
-                    await message.author.avatar_url_as(format="webp").save(directory_path / str(message.author.avatar_url_as(format="webp")).split("/")[-1].split("?")[0])
+                avatar = await save_avatar(message.author)
 
                 # Download emoji
-                for pattern, extension in [(static_emoji_regex, "png"), (gif_emoji_regex, "gif")]:
-                    for match in pattern.finditer(single_backtick.sub("", double_backtick.sub("", triple_backtick.sub("", message.content)))):
-                        if not (backup_path / "emoji" / f"{match.group(1)}.{extension}").exists():
-                            r = requests.get(f"https://cdn.discordapp.com/emojis/{match.group(1)}.{extension}")
-                            with open(backup_path / "emoji" / f"{match.group(1)}.{extension}", "wb") as f:
-                                f.write(r.content)
+                # Most messages don't have any custom emoji, so don't bother scanning those
+                if "<:" in message.content or "<a:" in message.content:
+                    content = message.content
+                    if "`" in content:
+                        # Emoji inside code blocks aren't rendered, so strip the code blocks
+                        content = CODE_BLOCK_REGEX.sub("", content)
+                    for pattern, extension in [(STATIC_EMOJI_REGEX, "png"), (GIF_EMOJI_REGEX, "gif")]:
+                        for match in pattern.finditer(content):
+                            emoji_file = f"{match.group(1)}.{extension}"
+                            if emoji_file not in saved_emoji:
+                                saved_emoji.add(emoji_file)
+                                pending_downloads[backup_path / "emoji" / emoji_file] = f"https://cdn.discordapp.com/emojis/{emoji_file}"
 
                 # Reactions
                 reactions = []
@@ -174,29 +287,25 @@ async def backup_messages():
                             emoji += "a"
                             extension = "gif"
                         # Download the emoji if it doesn't already exist
-                        if not (backup_path / "emoji" / f"{reaction.emoji.id}.{extension}").exists():
-                            r = requests.get(f"https://cdn.discordapp.com/emojis/{reaction.emoji.id}.{extension}")
-                            with open(backup_path / "emoji" / f"{reaction.emoji.id}.{extension}", "wb") as f:
-                                f.write(r.content)
+                        emoji_file = f"{reaction.emoji.id}.{extension}"
+                        if emoji_file not in saved_emoji:
+                            saved_emoji.add(emoji_file)
+                            pending_downloads[backup_path / "emoji" / emoji_file] = f"https://cdn.discordapp.com/emojis/{emoji_file}"
                         emoji += f":{reaction.emoji.name}:{reaction.emoji.id}"
                     else:
                         emoji += reaction.emoji
                     # `users` is the list of users who have reacted with this emoji
                     users = []
                     async for user in reaction.users():
-                        # Download avatar
-                        directory_path = backup_path / "avatars" / str(user.avatar_url_as(format="webp")).split("/")[-2]
-                        directory_path.mkdir(exist_ok=True)
-                        if not (directory_path / str(user.avatar_url_as(format="webp")).split("/")[-1].split("?")[0]).exists():
-                            await user.avatar_url_as(format="webp").save(directory_path / str(user.avatar_url_as(format="webp")).split("/")[-1].split("?")[0])
                         # Save the user to the database
-                        cur.execute("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)", (
+                        pending_users.setdefault(str(user.id), (
                             user.id,
                             user.display_name,
-                            "/".join(str(user.avatar_url_as(format="webp")).split("/")[-2:]).split("?")[0],
+                            await save_avatar(user),
                             int(user.bot),
                         ))
                         users.append(str(user.id))
+                        pending_reactions.append((message.id, emoji, str(user.id)))
                     # The final string we add to the list of reactions has both `emoji` and `users`
                     reactions.append(emoji + "-" + ",".join(users))
 
@@ -204,25 +313,25 @@ async def backup_messages():
                 attachments = []
                 for attachment in message.attachments:
                     segments = str(attachment).split("/")
-                    directory_path = backup_path / "attachments" / segments[-3] / segments[-2]
-                    directory_path.mkdir(parents=True, exist_ok=True)
-                    r = requests.get(attachment)
-                    with open(directory_path / segments[-1], "wb") as f:
-                        f.write(r.content)
+                    attachment_file = "/".join(segments[-3:])
+                    if attachment_file not in saved_attachments:
+                        saved_attachments.add(attachment_file)
+                        directory_path = backup_path / "attachments" / segments[-3] / segments[-2]
+                        directory_path.mkdir(parents=True, exist_ok=True)
+                        pending_downloads[directory_path / segments[-1]] = str(attachment)
                     attachments.append(str(attachment)[39:])
+                    pending_attachments.append((message.id, attachments[-1]))
 
                 # If the name color is the default color, save it as None
                 color = str(message.author.color)
-                if message.author.color == discord.colour.Colour.default():
+                if message.author.color == DEFAULT_COLOR:
                     color = None
-                # Avatar URL
-                avatar = "/".join(str(message.author.avatar_url_as(format="webp")).split("/")[-2:]).split("?")[0]
                 # 2 for webhooks, 1 for bots, 0 for normal users
                 bot = 2 if message.webhook_id else int(message.author.bot)
 
                 if not message.webhook_id:
                     # Save the user to the database
-                    cur.execute("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)", (
+                    pending_users.setdefault(str(message.author.id), (
                         message.author.id,
                         message.author.display_name,
                         avatar,
@@ -235,49 +344,62 @@ async def backup_messages():
                     embeds = None
 
                 # Save the message to the database
-                cur.execute(
-                    "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (
-                        message.id,
-                        message.channel.id,
-                        message.author.id,
-                        message.author.display_name,
-                        avatar,
-                        color,
-                        bot,
-                        message.created_at,
-                        message.edited_at,
-                        message.reference.message_id if message.reference else None,
-                        str(message.type).split(".")[1],
-                        message.system_content if len(message.system_content) else None,
-                        " ".join(attachments) if len(attachments) else None,
-                        embeds,
-                        " ".join(reactions) if len(reactions) else None,
-                    ),
-                )
+                pending_messages.append((
+                    message.id,
+                    message.channel.id,
+                    message.author.id,
+                    message.author.display_name,
+                    avatar,
+                    color,
+                    bot,
+                    message.created_at,
+                    message.edited_at,
+                    message.reference.message_id if message.reference else None,
+                    str(message.type).split(".")[1],
+                    message.system_content if len(message.system_content) else None,
+                    " ".join(attachments) if len(attachments) else None,
+                    embeds,
+                    " ".join(reactions) if len(reactions) else None,
+                ))
+                if len(pending_messages) >= BATCH_SIZE:
+                    flush_messages()
+                if len(pending_downloads) >= DOWNLOAD_BATCH_SIZE:
+                    await download_pending()
+            flush_messages()
+            flush_users()
+            await download_pending()
+            cur.execute("COMMIT")
             print(f"Backup of channel {channel.name} complete")
-    conn.commit()
+    # Index the child tables once they've been filled, instead of updating the indexes on every
+    # insert
+    cur.execute("CREATE INDEX message_attachments_message_id ON message_attachments (message_id)")
+    cur.execute("CREATE INDEX message_reactions_message_id_emoji ON message_reactions (message_id, emoji)")
+    await session.close()
     conn.close()
 
 
-async def index_messages():
-    # The guild we wanna backup
-    guild = get_guild()
-
-    if guild is None:
-        print(f"Error: guild {os.environ['GUILD']} not found")
-        sys.exit()
-
-    backup_path = Path(str(guild.id))
-
+async def index_messages(backup_path):
     # Create a database connection
-    conn = sqlite3.connect(backup_path / "backup.db")
+    conn = get_connection(backup_path)
     cur = conn.cursor()
     # (Re)create table
+    cur.execute("BEGIN")
     cur.execute("DROP TABLE IF EXISTS message_search")
-    cur.execute("CREATE VIRTUAL TABLE message_search USING FTS5(id, content, embeds)")
-    cur.execute("INSERT INTO message_search SELECT id, content, embeds FROM messages")
-    conn.commit()
+    # External content table, so the text is read from `messages` instead of being stored twice
+    cur.execute("""CREATE VIRTUAL TABLE message_search USING FTS5(
+            id,
+            content,
+            embeds,
+            content='messages',
+            content_rowid='id'
+        )""")
+    cur.execute("INSERT INTO message_search(message_search) VALUES('rebuild')")
+    # Merge the index segments built up while indexing
+    cur.execute("INSERT INTO message_search(message_search) VALUES('optimize')")
+    cur.execute("COMMIT")
+    # This is the last stage, so switch back to a rollback journal to leave a single
+    # self-contained database file that can be copied to the refrigerator
+    cur.execute("PRAGMA journal_mode=DELETE")
     conn.close()
 
 client.run(os.environ["TOKEN"])
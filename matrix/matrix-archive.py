@@ -2,7 +2,7 @@
 
 """matrix-archive
 
-Archive Matrix room messages. Creates a YAML log of all room
+Archive Matrix room messages. Creates a JSON log of all room
 messages, including media.
 
 Use the unattended batch mode to fetch everything in one go without
@@ -49,6 +49,7 @@ from nio import (
     AsyncClientConfig,
     LoginResponse,
     MatrixRoom,
+    MatrixUser,
     MessageDirection,
     RedactedEvent,
     RoomEncryptedMedia,
@@ -59,24 +60,35 @@ from nio import (
     store,
     exceptions
 )
-from functools import partial
+from collections import defaultdict
+from functools import lru_cache, partial
 from typing import Union, TextIO
 from urllib.parse import urlparse
 import aiofiles
 import argparse
 import asyncio
 import getpass
-import itertools
 import os
 import re
 import sys
 import json
+import orjson
 
 
 DEVICE_NAME = "91YkZaYpafk="
 CREDENTIALS = "credentials.json"
-
-
+# Characters that aren't allowed in filenames on NTFS
+SANITIZE_REGEX = re.compile(r"[\"*/:<>?\\|]")
+# The next duplicate number to try for each filename, so that `choose_filename` doesn't have
+# to check every number that's already taken
+FILENAME_COUNTERS = defaultdict(int)
+# Maximum number of simultaneous downloads from the homeserver
+MAX_DOWNLOADS = 16
+# Number of serialized events to buffer before writing them to the events file
+WRITE_BATCH_SIZE = 1000
+
+
+@lru_cache(maxsize=4096)
 def sanitize(value):
     """
     Make string safe for use as filename on NTFS filesystems
@@ -88,7 +100,7 @@ def sanitize(value):
     # value.lower() is useful because on unix we might be fine with foo.bar and Foo.bar as
     # attachments but on windows one would get overwritten. This way it'll be recognized as a
     # duplicate and get saved as foo(1).bar by `choose_filename`
-    return re.sub(r"[\"*/:<>?\\|]", "_", value.lower())
+    return SANITIZE_REGEX.sub("_", value.lower())
 
 
 def parse_args():
@@ -266,11 +278,19 @@ async def select_room(client: AsyncClient) -> MatrixRoom:
 
 def choose_filename(filename):
     start, ext = os.path.splitext(filename)
-    for i in itertools.count(1):
-        if not os.path.exists(filename):
-            break
-        filename = f"{start}({i}){ext}"
-    return filename
+    i = FILENAME_COUNTERS[filename]
+    choice = f"{start}({i}){ext}" if i else filename
+    while os.path.exists(choice):
+        i += 1
+        choice = f"{start}({i}){ext}"
+    FILENAME_COUNTERS[filename] = i + 1
+    return choice
+
+
+def apply_utimes(utimes):
+    # Set the atime and mtime (in nanoseconds) of each file
+    for filename, ns in utimes:
+        os.utime(filename, ns=(ns, ns))
 
 
 async def write_event(
@@ -282,18 +302,17 @@ async def write_event(
     if event.sender in room.users:
         # If user is still present in room, include current nickname
         sender_name = f"{room.users[event.sender].display_name} {sender_name}"
-    serialize_event = lambda event_payload: yaml.dump(
-        [
-            {
-                **dict(
-                    sender_id=event.sender,
-                    sender_name=sender_name,
-                    timestamp=event.server_timestamp,
-                ),
-                **event_payload,
-            }
-        ]
-    )
+    serialize_event = lambda event_payload: orjson.dumps(
+        {
+            **dict(
+                sender_id=event.sender,
+                sender_name=sender_name,
+                timestamp=event.server_timestamp,
+            ),
+            **event_payload,
+        },
+        option=orjson.OPT_APPEND_NEWLINE,
+    ).decode()
 
     if isinstance(event, RoomMessageFormatted):
         await output_file.write(serialize_event(dict(type="text", body=event.body,)))
@@ -303,7 +322,8 @@ async def write_event(
         async with aiofiles.open(filename, "wb") as f:
             try:
                 await f.write(
-                    crypto.attachments.decrypt_attachment(
+                    await asyncio.to_thread(
+                        crypto.attachments.decrypt_attachment,
                         media_data,
                         event.source["content"]["file"]["key"]["k"],
                         event.source["content"]["file"]["hashes"]["sha256"],
@@ -319,16 +339,26 @@ async def write_event(
         await output_file.write(serialize_event(dict(type="redacted",)))
 
 
-async def save_avatars(client: AsyncClient, room: MatrixRoom) -> None:
+async def save_avatar(
+    client: AsyncClient, semaphore: asyncio.Semaphore, avatar_dir: str, user: MatrixUser
+) -> tuple:
+    filename = user.avatar_url.split("/")[-1]
+    async with semaphore:
+        avatar = await download_mxc(client, user.avatar_url)
+    async with aiofiles.open(f"{avatar_dir}/{filename}", "wb") as f:
+        await f.write(avatar)
+    return user.user_id, filename
+
+
+async def save_avatars(client: AsyncClient, room: MatrixRoom) -> dict:
     avatar_dir = mkdir(f"{OUTPUT_DIR}/{sanitize(room.room_id)}/avatars")
-    avatars = {}
-    for user in room.users.values():
-        if user.avatar_url:
-            filename = user.avatar_url.split("/")[-1]
-            avatars[user.user_id] = filename
-            async with aiofiles.open(f"{avatar_dir}/{filename}", "wb") as f:
-                await f.write(await download_mxc(client, user.avatar_url))
-    return avatars
+    # Download all the avatars concurrently
+    semaphore = asyncio.Semaphore(MAX_DOWNLOADS)
+    return dict(await asyncio.gather(*[
+        save_avatar(client, semaphore, avatar_dir, user)
+        for user in room.users.values()
+        if user.avatar_url
+    ]))
 
 
 async def download_mxc(client: AsyncClient, url: str):
@@ -380,10 +410,42 @@ async def write_room_events(client, room):
     start_token = sync_resp.rooms.join[room.room_id].timeline.prev_batch
     fetch_room_events_ = partial(fetch_room_events, client, start_token, room)
     async with aiofiles.open(
-        f"{ROOM_PATH}/events.json", "w"
+        f"{ROOM_PATH}/events.json", "wb"
     ) as f_events:
-        events_parsed = []
-        for event in reversed(await fetch_room_events_(MessageDirection.back)):
+        events = list(reversed(await fetch_room_events_(MessageDirection.back)))
+        # Media is downloaded ahead of time, so that up to MAX_DOWNLOADS downloads are in
+        # flight while the earlier ones are being decrypted and written to disk
+        media_events = (
+            event for event in events
+            if isinstance(event, (RoomMessageMedia, RoomEncryptedMedia))
+        )
+        downloads = {}
+
+        def prefetch_media():
+            while len(downloads) < MAX_DOWNLOADS:
+                event = next(media_events, None)
+                if event is None:
+                    break
+                downloads[event.event_id] = asyncio.create_task(download_mxc(client, event.url))
+
+        prefetch_media()
+        # Serialized events waiting to be written out, so that the whole room never has to be held
+        # in memory as JSON at once
+        chunks = []
+        wrote_events = False
+
+        async def flush_events():
+            nonlocal wrote_events
+            # Continue the JSON array from the previous batch
+            separator = b"," if wrote_events else b""
+            await f_events.write(separator + b",".join(chunks))
+            chunks.clear()
+            wrote_events = True
+
+        await f_events.write(b"[")
+        # The timestamps are set once all the media of this room has been written
+        utimes = []
+        for event in events:
             try:
                 if not ARGS.no_media:
                     media_dir = mkdir(f"{ROOM_PATH}/media")
@@ -397,13 +459,15 @@ async def write_room_events(client, room):
 
                 # download media if necessary
                 if isinstance(event, (RoomMessageMedia, RoomEncryptedMedia)):
-                    media_data = await download_mxc(client, event.url)
+                    media_data = await downloads.pop(event.event_id)
+                    prefetch_media()
                     filename = choose_filename(f"{media_dir}/{sanitize(event.body)}")
                     event.source["_file_path"] = filename
                     async with aiofiles.open(filename, "wb") as f_media:
                         try:
                             await f_media.write(
-                                crypto.attachments.decrypt_attachment(
+                                await asyncio.to_thread(
+                                    crypto.attachments.decrypt_attachment,
                                     media_data,
                                     event.source["content"]["file"]["key"]["k"],
                                     event.source["content"]["file"]["hashes"]["sha256"],
@@ -412,15 +476,20 @@ async def write_room_events(client, room):
                             )
                         except KeyError:  # EAFP: Unencrypted media produces KeyError
                             await f_media.write(media_data)
-                        # Set atime and mtime of file to event timestamp
-                        os.utime(filename, ns=((event.server_timestamp * 1000000,) * 2))
+                    # Set atime and mtime of file to event timestamp
+                    utimes.append((filename, event.server_timestamp * 1000000))
 
                 # write out the processed message source
-                events_parsed.append(event.source)
+                # Not indented, since it's only read by matrix-convertor and can get very large
+                chunks.append(orjson.dumps(event.source))
+                if len(chunks) >= WRITE_BATCH_SIZE:
+                    await flush_events()
             except exceptions.EncryptionError as e:
                 print(e, file=sys.stderr)
-        # serialise message array
-        await f_events.write(json.dumps(events_parsed, indent=4))
+        if chunks:
+            await flush_events()
+        await f_events.write(b"]")
+    await asyncio.to_thread(apply_utimes, utimes)
 
     # Save room metadata
     async with aiofiles.open(f"{ROOM_PATH}/info.json", "w") as f_info:
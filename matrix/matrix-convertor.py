@@ -1,6 +1,9 @@
 from dotenv import load_dotenv
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timezone
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import posixpath
 import os
 import glob
@@ -8,6 +11,8 @@ import shutil
 import re
 import json
 import sqlite3
+import orjson
+import ijson
 
 load_dotenv()
 
@@ -15,8 +20,13 @@ INPUT_PATH = Path("input")
 OUTPUT_PATH = Path("backup")
 NAME_REGEX = re.compile(r"(.*) <@.*:.*>")
 NAME_FROM_TAG_REGEX = re.compile(r"@(.*):.*")
+# Characters that aren't allowed in filenames on NTFS
+SANITIZE_REGEX = re.compile(r"[\"*/:<>?\\|]")
+# Maximum number of rooms being parsed or waiting to be written at once
+MAX_ROOMS_IN_FLIGHT = os.cpu_count() or 1
 
 
+@lru_cache(maxsize=8192)
 def sanitize(value):
     """
     Make string safe for use as filename on NTFS filesystems
@@ -28,7 +38,7 @@ def sanitize(value):
     # value.lower() is useful because on unix we might be fine with foo.bar and Foo.bar as
     # attachments but on windows one would get overwritten. This way it'll be recognized as a
     # duplicate and get saved as foo(1).bar by `choose_filename`
-    return re.sub(r"[\"*/:<>?\\|]", "_", value.lower())
+    return SANITIZE_REGEX.sub("_", value.lower())
 
 
 def mkdir(path):
@@ -38,141 +48,226 @@ def mkdir(path):
     os.mkdir(path)
 
 
-def backup_messages():
-    conn = sqlite3.connect(OUTPUT_PATH / "backup.db")
-    cur = conn.cursor()
+def fast_copy(src, dst):
+    # Hardlink the file if possible, which is much faster than copying it for big attachments.
+    # This fails if the input and output are on different filesystems, so copy it in that case
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        # Overwrite it like shutil.copyfile would. It might even be a link to the same file
+        os.remove(dst)
+        fast_copy(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
 
-    for f_events in glob.iglob(str(INPUT_PATH / "*/events.json")):
-        # Get saved avatars
-        with open(Path(os.path.dirname(f_events)) / "info.json", "r") as f:
-            info = json.load(f)
-            avatars = info["user_avatars"]
-        with open(f_events, "r") as f:
-            events = json.load(f)
-            for event in events:
-                if (
-                        "m.relates_to" in event["content"]
-                        and "rel_type" in event["content"]["m.relates_to"]
-                        and event["content"]["m.relates_to"]["rel_type"] == "m.replace"
-                    ):
-                    # This is an edit
-                    original_id = event["content"]["m.relates_to"]["event_id"]
-                    cur.execute(
-                        "SELECT edits FROM messages WHERE id = ?",
-                        (original_id,),
-                    )
-                    edits = cur.fetchone()[0]
-                    if edits:
-                        edits = json.loads(edits)
-                    else:
-                        edits = []
-
-                    try:
-                        message_format = event["content"]["m.new_content"]["format"]
-                        formatted_content = event["content"]["m.new_content"]["formatted_body"]
-                    except KeyError:
-                        message_format = formatted_content = None
-
-                    edits.append([
-                        event["origin_server_ts"],
-                        event["content"]["m.new_content"]["msgtype"],
-                        event["content"]["m.new_content"]["body"],
-                        message_format,
-                        formatted_content,
-                    ])
-                    cur.execute("UPDATE messages SET edits = ? WHERE id = ?", (
-                        json.dumps(edits), original_id
-                    ))
+
+def get_connection():
+    # Autocommit mode, so that transactions are only opened where we explicitly BEGIN them
+    conn = sqlite3.connect(OUTPUT_PATH / "backup.db", isolation_level=None)
+    # The database is recreated from scratch on every run, so there's no need to fsync it
+    conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=OFF;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-64000;
+    """)
+    return conn
+
+
+def process_room(f_events):
+    """
+    Parse a room's events into rows for the database, without touching the database itself, so
+    that rooms can be processed in parallel while the main process does all the writing
+    """
+    # The first row of each sender in this room
+    user_rows = []
+    seen_users = set()
+    message_rows = []
+    edit_rows = []
+    # (source, destination) pairs of attachments to copy into the backup
+    file_copies = []
+
+    attachments_dst = OUTPUT_PATH / "attachments"
+    # Get saved avatars
+    with open(Path(os.path.dirname(f_events)) / "info.json", "rb") as f:
+        info = orjson.loads(f.read())
+        avatars = info["user_avatars"]
+    # Parse the events one at a time instead of loading the whole room into memory
+    # ijson's C backend needs a binary stream
+    with open(f_events, "rb") as f:
+        for event in ijson.items(f, "item"):
+            if (
+                    "m.relates_to" in event["content"]
+                    and "rel_type" in event["content"]["m.relates_to"]
+                    and event["content"]["m.relates_to"]["rel_type"] == "m.replace"
+                ):
+                # This is an edit
+                original_id = event["content"]["m.relates_to"]["event_id"]
+
+                try:
+                    message_format = event["content"]["m.new_content"]["format"]
+                    formatted_content = event["content"]["m.new_content"]["formatted_body"]
+                except KeyError:
+                    message_format = formatted_content = None
+
+                edit_rows.append((original_id, [
+                    event["origin_server_ts"],
+                    event["content"]["m.new_content"]["msgtype"],
+                    event["content"]["m.new_content"]["body"],
+                    message_format,
+                    formatted_content,
+                ]))
+            else:
+                # Get the sender's details
+                avatar = avatars.get(event["sender"])
+                sender_name = ""
+                if "_sender_name" in event:
+                    name = NAME_REGEX.match(event["_sender_name"]).group(1)
                 else:
-                    # Save the user to the database
-                    try:
-                        avatar = avatars[event["sender"]]
-                        if not (OUTPUT_PATH / "avatars" / avatar).exists():
-                            shutil.copyfile(Path(os.path.dirname(f_events)) / "avatars" / avatar, OUTPUT_PATH / "avatars" / avatar)
-                    except KeyError:
-                        avatar = None
-                    sender_name = ""
-                    if "_sender_name" in event:
-                        name = NAME_REGEX.match(event["_sender_name"]).group(1)
-                    else:
-                        # This user is no longer in the room
-                        name = NAME_FROM_TAG_REGEX.match(event["sender"]).group((1))
-
-                    cur.execute("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)", (
+                    # This user is no longer in the room
+                    name = NAME_FROM_TAG_REGEX.match(event["sender"]).group((1))
+
+                if event["sender"] not in seen_users:
+                    seen_users.add(event["sender"])
+                    user_rows.append((
                         event["sender"],
                         name,
                         avatar,
                         None,
                     ))
 
-                    # Save the event to the database
-                    if "redacted_because" in event:
-                        msgtype = "m.room.redaction"
-                        content = None
-                    else:
-                        msgtype = event["content"]["msgtype"]
-                        content = event["content"]["body"]
-
-                    try:
-                        message_format = event["content"]["format"]
-                        formatted_content = event["content"]["formatted_body"]
-                    except KeyError:
-                        message_format = formatted_content = None
-
-                    # Reply
-                    try:
-                        reference = event["content"]["m.relates_to"]["m.in_reply_to"]["event_id"]
-                    except KeyError:
-                        reference = None
-                    
-                    # Attachment
-                    if msgtype == "m.image" or msgtype == "m.file":
-                        # Create a directory for this room's attachments if it doesn't exist yet
-                        room_attachments = OUTPUT_PATH / "attachments" / sanitize(event["room_id"])
-                        if not room_attachments.exists():
-                            os.mkdir(room_attachments)
-                        
-                        # Create a directory for this attachment
-                        # This is so that we don't have to worry about duplicate attachment names
-                        os.mkdir(room_attachments / sanitize(event["event_id"]))
-                        attachment_path = room_attachments / sanitize(event["event_id"]) / sanitize(event["content"]["body"])
-                        # Remove OUTPUT_PATH/attachments and use forward slashes as separators
-                        content = posixpath.join(*str(attachment_path).split(os.sep)[2:])
-                        shutil.copyfile(
-                            "/".join([str(INPUT_PATH)] + event["_file_path"].split("/")[1:]),
-                            attachment_path,
-                        )
-
-                    cur.execute(
-                        "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                        (
-                            event["event_id"],
-                            event["room_id"],
-                            event["sender"],
-                            name,
-                            avatar,
-                            None,
-                            datetime.utcfromtimestamp(event["origin_server_ts"] / 1000),
-                            None,
-                            reference,
-                            msgtype,
-                            content,
-                            message_format,
-                            formatted_content,
-                        )
+                # Get the event's details
+                if "redacted_because" in event:
+                    msgtype = "m.room.redaction"
+                    content = None
+                else:
+                    msgtype = event["content"]["msgtype"]
+                    content = event["content"]["body"]
+
+                try:
+                    message_format = event["content"]["format"]
+                    formatted_content = event["content"]["formatted_body"]
+                except KeyError:
+                    message_format = formatted_content = None
+
+                # Reply
+                try:
+                    reference = event["content"]["m.relates_to"]["m.in_reply_to"]["event_id"]
+                except KeyError:
+                    reference = None
+                
+                # Attachment
+                if msgtype == "m.image" or msgtype == "m.file":
+                    # Each attachment gets its own directory inside the room's directory
+                    # This is so that we don't have to worry about duplicate attachment names
+                    attachment_path = (
+                        attachments_dst
+                        / sanitize(event["room_id"])
+                        / sanitize(event["event_id"])
+                        / sanitize(event["content"]["body"])
                     )
-    conn.commit()
+                    # Remove OUTPUT_PATH/attachments and use forward slashes as separators
+                    content = posixpath.join(*str(attachment_path).split(os.sep)[2:])
+                    file_copies.append((
+                        "/".join([str(INPUT_PATH)] + event["_file_path"].split("/")[1:]),
+                        attachment_path,
+                    ))
+
+                message_rows.append((
+                    event["event_id"],
+                    event["room_id"],
+                    event["sender"],
+                    name,
+                    avatar,
+                    None,
+                    datetime.fromtimestamp(event["origin_server_ts"] / 1000, timezone.utc).replace(tzinfo=None),
+                    None,
+                    reference,
+                    msgtype,
+                    content,
+                    message_format,
+                    formatted_content,
+                ))
+    return user_rows, message_rows, edit_rows, file_copies
+
+
+def backup_messages():
+    conn = get_connection()
+    cur = conn.cursor()
+
+    # Users and edits of each original message, written once all the rooms have been processed
+    pending_users = []
+    seen_users = set()
+    pending_edits = defaultdict(list)
+    avatars_dst = OUTPUT_PATH / "avatars"
+    # Avatars that already exist in the output
+    copied_avatars = set()
+
+    def write_room(f_events, user_rows, message_rows, edit_rows, file_copies):
+        for user in user_rows:
+            # Users without an avatar don't fit in the users table, so a later room where
+            # they have one still gets to add them
+            if user[0] not in seen_users and user[2] is not None:
+                seen_users.add(user[0])
+                pending_users.append(user)
+        cur.executemany(
+            "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            message_rows,
+        )
+        for original_id, edit in edit_rows:
+            pending_edits[original_id].append(edit)
+        avatars_src = Path(os.path.dirname(f_events)) / "avatars"
+        for _, _, avatar, _ in user_rows:
+            if avatar and avatar not in copied_avatars:
+                copied_avatars.add(avatar)
+                if not (avatars_dst / avatar).exists():
+                    fast_copy(avatars_src / avatar, avatars_dst / avatar)
+        for src, dst in file_copies:
+            # Create the room's directory too if this is its first attachment
+            os.makedirs(dst.parent)
+            fast_copy(src, dst)
+
+    cur.execute("BEGIN")
+    # Rooms are independent, so parse them in separate processes and do all the writes here.
+    # The rooms are written in order, so the first room a user appears in still decides their
+    # name and avatar. Only MAX_ROOMS_IN_FLIGHT rooms are submitted at a time, so that the rows
+    # of later rooms don't pile up here while an earlier room is still being parsed
+    in_flight = deque()
+    with ProcessPoolExecutor(max_workers=MAX_ROOMS_IN_FLIGHT) as executor:
+        for f_events in glob.iglob(str(INPUT_PATH / "*/events.json")):
+            in_flight.append((f_events, executor.submit(process_room, f_events)))
+            if len(in_flight) >= MAX_ROOMS_IN_FLIGHT:
+                f_room, future = in_flight.popleft()
+                write_room(f_room, *future.result())
+        while in_flight:
+            f_room, future = in_flight.popleft()
+            write_room(f_room, *future.result())
+    cur.executemany("INSERT INTO users VALUES (?, ?, ?, ?)", pending_users)
+    cur.executemany(
+        "UPDATE messages SET edits = ? WHERE id = ?",
+        ((orjson.dumps(edits).decode(), original_id) for original_id, edits in pending_edits.items()),
+    )
+    cur.execute("COMMIT")
     conn.close()
 
 
 def index_messages():
-    conn = sqlite3.connect(OUTPUT_PATH / "backup.db")
+    conn = get_connection()
     cur = conn.cursor()
     # (Re)create table
+    cur.execute("BEGIN")
     cur.execute("DROP TABLE IF EXISTS message_search")
-    cur.execute("CREATE VIRTUAL TABLE message_search USING FTS5(id, content, edits)")
-    cur.execute("INSERT INTO message_search SELECT id, content, edits FROM messages")
-    conn.commit()
+    # Read the text from the messages table instead of storing a second copy of it in the index.
+    # messages has a TEXT primary key, so the index refers to rows by their implicit rowid, which
+    # stays stable as long as the database isn't VACUUMed
+    cur.execute("""CREATE VIRTUAL TABLE message_search USING FTS5(
+            id UNINDEXED, content, edits, content='messages', content_rowid='rowid'
+        )""")
+    cur.execute("INSERT INTO message_search(message_search) VALUES('rebuild')")
+    cur.execute("COMMIT")
+    # This is the last stage, so switch back to a rollback journal to leave a single
+    # self-contained database file that can be copied to the refrigerator
+    cur.execute("PRAGMA journal_mode=DELETE")
     conn.close()
 
 
@@ -186,9 +281,9 @@ if __name__ == "__main__":
             "name": "matrix chats",
             "icon": "matrix.png"
         }, f)
-        shutil.copyfile("matrix.png", OUTPUT_PATH / "matrix.png")
+        fast_copy("matrix.png", OUTPUT_PATH / "matrix.png")
 
-    conn = sqlite3.connect(OUTPUT_PATH / "backup.db")
+    conn = get_connection()
     cur = conn.cursor()
     # Create chats table
     cur.execute("DROP TABLE IF EXISTS chats")
@@ -227,9 +322,10 @@ if __name__ == "__main__":
     mkdir(OUTPUT_PATH / "avatars")
     mkdir(OUTPUT_PATH / "attachments")
 
+    cur.execute("BEGIN")
     for f_info in glob.iglob(str(INPUT_PATH / "*/info.json")):
-        with open(f_info, "r") as f:
-            info = json.load(f)
+        with open(f_info, "rb") as f:
+            info = orjson.loads(f.read())
             # Save the room details to the database
             cur.execute(
                 "INSERT INTO chats VALUES (?, ?, ?, ?)",
@@ -237,8 +333,8 @@ if __name__ == "__main__":
             )
             # Copy avatar if it's specified
             if info["avatar"]:
-                shutil.copyfile(Path(os.path.dirname(f_info)) / info["avatar"], OUTPUT_PATH / "avatars" / info["avatar"])
-    conn.commit()
+                fast_copy(Path(os.path.dirname(f_info)) / info["avatar"], OUTPUT_PATH / "avatars" / info["avatar"])
+    cur.execute("COMMIT")
     conn.close()
     backup_messages()
     index_messages()
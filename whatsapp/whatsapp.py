@@ -1,5 +1,6 @@
 from datetime import datetime
 from pathlib import Path
+from itertools import islice
 import html
 import re
 import glob
@@ -8,10 +9,26 @@ import shutil
 import ntpath
 import json
 import sqlite3
+import orjson
 import shortuuid
 
 INPUT_PATH = Path("whatsapp_exports")
 OUTPUT_PATH = Path("wa_backup")
+# Number of messages to buffer before writing them to the database
+BATCH_SIZE = 1000
+
+CHAT_FILE_REGEX = re.compile(r".*[/\\]WhatsApp Chat with (.+).txt")
+COLOR_REGEX = re.compile(r"^#(?:[0-9a-fA-F]{3}){1,2}$")
+# The first line of a message. If there's no name, it's a system message
+LINE_REGEX = re.compile(r"^(\d\d)/(\d\d)/(\d\d), (\d\d):(\d\d) - (?:([^:]+): )?(.+)$")
+IMAGE_REGEX = re.compile(r"(.*?)(IMG-[^ ]+\.jpg) \(file attached\)$")
+# Markdown
+ITALIC_REGEX = re.compile(r"```(.+?)```|\b_(.+?)_")
+BOLD_REGEX = re.compile(r"(```(.+?)```|(\W|^)\*([^*]+)\*(?=\W|$))")
+STRIKETHROUGH_REGEX = re.compile(r"(```(.+?)```|(\W|^)~([^~]+)~(?=\W|$))")
+MONOSPACE_REGEX = re.compile(r"```(.+?)```", re.DOTALL)
+# Matches anything that might be formatted by `parse_markdown`, so we can skip plain messages
+HAS_MARKDOWN_REGEX = re.compile(r"```|_.+_|\*[^*]+\*|~[^~]+~")
 
 
 def mkdir(path):
@@ -21,8 +38,34 @@ def mkdir(path):
     os.mkdir(path)
 
 
+def fast_copy(src, dst):
+    # Hardlink the file if possible, which is much faster than copying it for big attachments.
+    # This fails if the input and output are on different filesystems, so copy it in that case
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        # Overwrite it like shutil.copyfile would. It might even be a link to the same file
+        os.remove(dst)
+        fast_copy(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def get_connection():
+    # Autocommit mode, so that transactions are only opened where we explicitly BEGIN them
+    conn = sqlite3.connect(OUTPUT_PATH / "backup.db", isolation_level=None)
+    # The database is recreated from scratch on every run, so there's no need to fsync it
+    conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=OFF;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-64000;
+    """)
+    return conn
+
+
 def validate_color(color):
-    return not not re.search(r"^#(?:[0-9a-fA-F]{3}){1,2}$", color)
+    return not not COLOR_REGEX.search(color)
 
 
 def parse_markdown(text, test):
@@ -32,26 +75,29 @@ def parse_markdown(text, test):
     if not test:
         # Escape HTML
         text = html.escape(text, quote=False)
+    # Each pass leaves the text unchanged unless its marker is in it, and neither escaping nor
+    # the tags added by earlier passes introduce markers, so skip the passes that can't match
     # Italics
-    text = re.sub(
-        r"```(.+?)```|\b_(.+?)_",
-        lambda m: f"<em>{m.group(2)}</em>" if m.group(2) else m.group(0),
-        text
-    )
+    if "_" in text:
+        text = ITALIC_REGEX.sub(
+            lambda m: f"<em>{m.group(2)}</em>" if m.group(2) else m.group(0),
+            text
+        )
     # Bold
-    text = re.sub(
-        r"(```(.+?)```|(\W|^)\*([^*]+)\*(?=\W|$))",
-        lambda m: f"{m.group(3)}<strong>{m.group(4)}</strong>" if m.group(4) else m.group(0),
-        text
-    )
+    if "*" in text:
+        text = BOLD_REGEX.sub(
+            lambda m: f"{m.group(3)}<strong>{m.group(4)}</strong>" if m.group(4) else m.group(0),
+            text
+        )
     # Strikethrough
-    text = re.sub(
-        r"(```(.+?)```|(\W|^)~([^~]+)~(?=\W|$))",
-        lambda m: f"{m.group(3)}<del>{m.group(4)}</del>" if m.group(4) else m.group(0),
-        text
-    )
+    if "~" in text:
+        text = STRIKETHROUGH_REGEX.sub(
+            lambda m: f"{m.group(3)}<del>{m.group(4)}</del>" if m.group(4) else m.group(0),
+            text
+        )
     # Monospace
-    text = re.sub(r"```(.+?)```", r"<pre>\1</pre>", text, flags=re.DOTALL)
+    if "```" in text:
+        text = MONOSPACE_REGEX.sub(r"<pre>\1</pre>", text)
     # Newlines are normally handled by cheesecake for the unformatted content field
     if not test:
         # Newlines
@@ -59,23 +105,56 @@ def parse_markdown(text, test):
     return text
 
 
-def backup_users(filepath, existing_users, existing_ids):
-    with open(filepath, "r", encoding="UTF-8") as f:
-        lines = f.readlines()
+def format_markdown(text):
+    # Returns the formatted HTML if `text` has any formatting, and None otherwise
+    if not HAS_MARKDOWN_REGEX.search(text):
+        return None
+    formatted = parse_markdown(text, False)
+    if formatted == html.escape(text, quote=False).replace("\n", "<br>"):
+        return None
+    return formatted
 
-    info = {}
-    if (INPUT_PATH / "info.json").exists():
-        with open(INPUT_PATH / "info.json", "r", encoding="UTF-8") as f:
-            info = json.load(f)
 
-    user_regex = re.compile(r"^\d\d/\d\d/\d\d, \d\d:\d\d - ([^:]+): .+")
+def read_names(filepath):
+    # Returns the names of everyone who has sent a message
     # The names only have to be unique within this group, not necessarily through the whole backup
     # The names are unique because WhatsApp's export format doesn't give us unique IDs and we only
     # have their names, so we can't differentiate two people with the same name
     names = set()
-    for line in lines:
-        if match := user_regex.match(line):
-            names.add(match.group(1))
+    with open(filepath, "r", encoding="UTF-8") as f:
+        for line in f:
+            if (match := LINE_REGEX.match(line)) and match.group(6) is not None:
+                names.add(match.group(6))
+
+    return names
+
+
+def parse_chat_file(filepath):
+    # Yields the lines of the chat along with their (day, month, year, hour, minute, name, content)
+    # fields, or None if a line is the continuation of a previous message
+    # The file is read lazily, so only the lines that are currently being looked at are in memory
+    with open(filepath, "r", encoding="UTF-8") as f:
+        for line in f:
+            match = LINE_REGEX.match(line)
+            yield line, match.groups() if match else None
+
+
+def with_next(iterable):
+    # Yields each item along with the item after it, or None for the last item
+    iterator = iter(iterable)
+    current = next(iterator, None)
+    for following in iterator:
+        yield current, following
+        current = following
+    if current is not None:
+        yield current, None
+
+
+def backup_users(names, existing_users, existing_ids):
+    info = {}
+    if (INPUT_PATH / "info.json").exists():
+        with open(INPUT_PATH / "info.json", "rb") as f:
+            info = orjson.loads(f.read())
 
     # For new users to be added to the database (not covered in previous chats)
     new_users = {}
@@ -96,11 +175,11 @@ def backup_users(filepath, existing_users, existing_ids):
                 skip = True
                 if name not in existing_users:
                     if info["users"][name]["avatar"] is None:
-                        shutil.copyfile("default.svg", OUTPUT_PATH / "avatars/default.svg")
+                        fast_copy("default.svg", OUTPUT_PATH / "avatars/default.svg")
                         info["users"][name]["avatar"] = "default.svg"
                     else:
                         target = shortuuid.uuid() + os.path.splitext(info["users"][name]["avatar"])[1]
-                        shutil.copyfile(INPUT_PATH / info["users"][name]["avatar"], OUTPUT_PATH / "avatars" / target)
+                        fast_copy(INPUT_PATH / info["users"][name]["avatar"], OUTPUT_PATH / "avatars" / target)
                         info["users"][name]["avatar"] = target
                     new_users[info["users"][name]["user_id"]] = {
                         "name": name,
@@ -146,7 +225,7 @@ def backup_users(filepath, existing_users, existing_ids):
             avatar = input(f"Enter the path to {name}'s avatar: ").strip()
 
         target = shortuuid.uuid() + os.path.splitext(avatar)[1]
-        shutil.copyfile(avatar, OUTPUT_PATH / "avatars" / target)
+        fast_copy(avatar, OUTPUT_PATH / "avatars" / target)
         avatar = target
 
         # The color their name should show up in
@@ -177,98 +256,96 @@ def backup_users(filepath, existing_users, existing_ids):
     return new_users, group_users
 
 
-def backup_messages(filepath, chat_id, group_users):
-    messages = []
-    with open(filepath, "r", encoding="UTF-8") as f:
-        lines = f.readlines()
-
-    pattern = re.compile(r"(\d\d)/(\d\d)/(\d\d), (\d\d):(\d\d) - ([^:]+): (.+)")
-    # If a message doesn't match `pattern` but matches `skip_pattern` it's a system message
-    skip_pattern = re.compile(r"(\d\d)/(\d\d)/(\d\d), (\d\d):(\d\d) - .+")
-
+def backup_messages(filepath, lines, chat_id, group_users):
+    # Yields a row for the messages table for each message, once all of its lines have been read
+    # The columns of the message that's currently being read, up to its content
+    pending = None
     skip = False
 
-    for i, line in enumerate(lines):
+    for (line, fields), next_line in with_next(lines):
         if skip:
             # If we've already handled this line in the previous iteration
             skip = False
             continue
 
-        if match := pattern.match(line):
+        if fields and fields[5] is not None:
+            # This is the start of a new message, so the previous one is complete
+            if pending is not None:
+                yield (*pending, content, message_format, formatted_content, attachment)
+
             # Modify this based on what date format your WhatsApp exports use
-            year = int("20" + match.group(3))
-            month = int(match.group(2))
-            day = int(match.group(1))
-            hour = int(match.group(4))
-            minute = int(match.group(5))
-            name = match.group(6)
-
-            if match.group(7) == "This message was deleted" or match.group(7) == "You deleted this message":
+            year = int("20" + fields[2])
+            month = int(fields[1])
+            day = int(fields[0])
+            hour = int(fields[3])
+            minute = int(fields[4])
+            name = fields[5]
+
+            if fields[6] == "This message was deleted" or fields[6] == "You deleted this message":
                 message_type = "redacted"
                 content = ""
             else:
                 message_type = "default"
-                content = match.group(7)
+                content = fields[6]
 
             attachment = None
             # Image
-            if match := re.match(r"(.*)(IMG-.+.jpg) \(file attached\)", content):
+            if match := IMAGE_REGEX.match(content):
                 attachment = Path(os.path.dirname(filepath)) / match.group(2)
                 content = match.group(1)
-                if len(lines) > i + 1:
-                    if not pattern.match(lines[i + 1]) and not skip_pattern.match(lines[i + 1]):
-                        content += lines[i + 1]
+                if next_line is not None:
+                    if next_line[1] is None:
+                        content += next_line[0]
                         skip = True
-            elif content[-16:] == " (file attached)":
+            elif content.endswith(" (file attached)"):
                 attachment = Path(os.path.dirname(filepath)) / content[:-16]
-                if len(lines) > i + 1:
-                    if lines[i + 1].strip() == content[:-16].strip():
+                if next_line is not None:
+                    if next_line[0].strip() == content[:-16].strip():
                         skip = True
                 content = ""
             # Copy the attachment
             if attachment:
                 if not (OUTPUT_PATH / "attachments" / chat_id).exists():
                     mkdir(OUTPUT_PATH / "attachments" / chat_id)
-                shutil.copyfile(attachment, OUTPUT_PATH / "attachments" / chat_id / ntpath.basename(attachment))
+                fast_copy(attachment, OUTPUT_PATH / "attachments" / chat_id / ntpath.basename(attachment))
                 attachment = chat_id + "/" + ntpath.basename(attachment)
 
+            stripped = content.strip()
             message_format = None
             formatted_content = None
-            if len(content.strip()):
-                if content.strip() != parse_markdown(content.strip(), True):
+            if len(stripped):
+                if formatted_content := format_markdown(stripped):
                     message_format = "whatsapp_markdown"
-                    formatted_content = parse_markdown(content.strip(), False)
-
-            messages.append({
-                "id": shortuuid.uuid(),
-                "user_id": group_users[name]["user_id"],
-                "name": name,
-                "avatar": group_users[name]["avatar"],
-                "color": group_users[name]["color"],
-                "created_timestamp": datetime(year, month, day, hour, minute).astimezone(),
-                "message_type": message_type,
-                "content": content.strip() if len(content.strip()) else None,
-                "format": message_format,
-                "formatted_content": formatted_content,
-                "attachments": json.dumps([attachment]) if attachment else None,
-            })
-        elif len(messages) > 0:
+
+            pending = (
+                shortuuid.uuid(),
+                chat_id,
+                group_users[name]["user_id"],
+                name,
+                group_users[name]["avatar"],
+                group_users[name]["color"],
+                datetime(year, month, day, hour, minute).astimezone(),
+                None,
+                None,
+                message_type,
+            )
+            content = stripped if len(stripped) else None
+            attachment = orjson.dumps([attachment]).decode() if attachment else None
+        elif pending is not None:
             # This line is either a system message or a continuation of the previous message
-            if messages[-1]["content"] and not skip_pattern.match(line):
-                new_content = messages[-1]["content"] + "\n" + line.strip()
-                if new_content != parse_markdown(new_content, True):
+            if fields is None:
+                if content:
+                    new_content = content + "\n" + line.strip()
+                else:
+                    new_content = line.strip()
+                if new_formatted_content := format_markdown(new_content):
                     # The new content has formatting
-                    messages[-1]["format"] = "whatsapp_markdown"
-                    messages[-1]["formatted_content"] = parse_markdown(new_content, False)
-                messages[-1]["content"] = new_content
-            elif not skip_pattern.match(line):
-                new_content = line.strip()
-                if new_content != parse_markdown(new_content, True):
-                    messages[-1]["format"] = "whatsapp_markdown"
-                    messages[-1]["formatted_content"] = parse_markdown(new_content, False)
-                messages[-1]["content"] = new_content
+                    message_format = "whatsapp_markdown"
+                    formatted_content = new_formatted_content
+                content = new_content
 
-    return messages
+    if pending is not None:
+        yield (*pending, content, message_format, formatted_content, attachment)
 
 
 def initialize_backup():
@@ -282,9 +359,9 @@ def initialize_backup():
             "name": "WhatsApp chats",
             "icon": "whatsapp.png"
         }, f)
-        shutil.copyfile("whatsapp.png", OUTPUT_PATH / "whatsapp.png")
+        fast_copy("whatsapp.png", OUTPUT_PATH / "whatsapp.png")
 
-    conn = sqlite3.connect(OUTPUT_PATH / "backup.db")
+    conn = get_connection()
     cur = conn.cursor()
     # Create chats table
     cur.execute("DROP TABLE IF EXISTS chats")
@@ -328,11 +405,12 @@ def initialize_backup():
     user_ids = set()
     info = {}
     if (INPUT_PATH / "info.json").exists():
-        with open(INPUT_PATH / "info.json", "r", encoding="UTF-8") as f:
-            info = json.load(f)
+        with open(INPUT_PATH / "info.json", "rb") as f:
+            info = orjson.loads(f.read())
 
+    cur.execute("BEGIN")
     for filepath in glob.iglob(str(INPUT_PATH / "*/*.txt")):
-        if match := re.match(r".*[/\\]WhatsApp Chat with (.+).txt", filepath):
+        if match := CHAT_FILE_REGEX.match(filepath):
             chat_id = shortuuid.uuid()
 
             name = match.group(1)
@@ -354,7 +432,7 @@ def initialize_backup():
             # Copy avatar if it's specified
             if avatar:
                 target = shortuuid.uuid() + os.path.splitext(avatar)[1]
-                shutil.copyfile(avatar, OUTPUT_PATH / "avatars" / target)
+                fast_copy(avatar, OUTPUT_PATH / "avatars" / target)
                 avatar = target
 
             # Topic
@@ -371,54 +449,50 @@ def initialize_backup():
             )
             print("\nUsers:")
 
-            new_users, group_users = backup_users(filepath, users, user_ids)
+            # Every sender has to be known before their messages can be written, so the names are
+            # read in a separate pass over the file
+            new_users, group_users = backup_users(read_names(filepath), users, user_ids)
             # Iterate over the new users in this group (who aren't part of any previous groups)
-            for user in new_users:
-                cur.execute(
-                    "INSERT INTO users VALUES (?, ?, ?, ?)",
-                    (user, new_users[user]["name"], new_users[user]["avatar"], new_users[user]["color"]),
-                )
+            cur.executemany("INSERT INTO users VALUES (?, ?, ?, ?)", [
+                (user, new_users[user]["name"], new_users[user]["avatar"], new_users[user]["color"])
+                for user in new_users
+            ])
 
             # Add these users to the existing users dictionary
             user_ids.update(new_users.keys())
             users.update(group_users)
 
             # Backup messages
-            for message in backup_messages(filepath, chat_id, group_users):
-                cur.execute(
+            messages = backup_messages(filepath, parse_chat_file(filepath), chat_id, group_users)
+            while batch := list(islice(messages, BATCH_SIZE)):
+                cur.executemany(
                     "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (
-                        message["id"],
-                        chat_id,
-                        message["user_id"],
-                        message["name"],
-                        message["avatar"],
-                        message["color"],
-                        message["created_timestamp"],
-                        None,
-                        None,
-                        message["message_type"],
-                        message["content"],
-                        message["format"],
-                        message["formatted_content"],
-                        message["attachments"],
-                    ),
+                    batch,
                 )
 
+    cur.execute("COMMIT")
     print("Converted files saved to", OUTPUT_PATH)
 
-    conn.commit()
     conn.close()
 
 
 def index_messages():
-    conn = sqlite3.connect(OUTPUT_PATH / "backup.db")
+    conn = get_connection()
     cur = conn.cursor()
     # (Re)create table
+    cur.execute("BEGIN")
     cur.execute("DROP TABLE IF EXISTS message_search")
-    cur.execute("CREATE VIRTUAL TABLE message_search USING FTS5(id, content)")
-    cur.execute("INSERT INTO message_search SELECT id, content FROM messages")
-    conn.commit()
+    # Read the text from the messages table instead of storing a second copy of it in the index.
+    # messages has a TEXT primary key, so the index refers to rows by their implicit rowid, which
+    # stays stable as long as the database isn't VACUUMed
+    cur.execute("""CREATE VIRTUAL TABLE message_search USING FTS5(
+            id UNINDEXED, content, content='messages', content_rowid='rowid'
+        )""")
+    cur.execute("INSERT INTO message_search(message_search) VALUES('rebuild')")
+    cur.execute("COMMIT")
+    # This is the last stage, so switch back to a rollback journal to leave a single
+    # self-contained database file that can be copied to the refrigerator
+    cur.execute("PRAGMA journal_mode=DELETE")
     conn.close()
 
 